@@ -0,0 +1,81 @@
+"""
+ProTrader 共用常數：代碼對照表、模型清單與畫面樣板
+(放在獨立模組只會載入一次，Streamlit 每次重跑 app.py 不必重建)
+"""
+import re
+from string import Template
+from types import MappingProxyType
+
+# ===========================
+# 1. 常用台股代碼對照表
+# ===========================
+# 唯讀對照表，避免任何模組在執行期誤改共用資料
+TW_STOCK_NAMES = MappingProxyType({
+    "2330": "台積電", "2317": "鴻海", "2454": "聯發科", "2303": "聯電", "2308": "台達電",
+    "2881": "富邦金", "2882": "國泰金", "2891": "中信金", "2886": "兆豐金", "2884": "玉山金",
+    "2603": "長榮", "2609": "陽明", "2615": "萬海", "2618": "長榮航", "2610": "華航",
+    "3008": "大立光", "3034": "聯詠", "3037": "欣興", "3045": "台灣大", "2412": "中華電",
+    "2912": "統一超", "1216": "統一", "2002": "中鋼", "1101": "台泥", "1102": "亞泥",
+    "3231": "緯創", "2382": "廣達", "2376": "技嘉", "2356": "英業達", "6669": "緯穎",
+    "2324": "仁寶", "2357": "華碩", "2301": "光寶科", "2344": "華邦電", "2409": "友達",
+    "3481": "群創", "2395": "研華", "5871": "中租-KY", "9910": "豐泰", "9921": "巨大"
+})
+
+# 輸入代號時全形/半形逗號與空白都當分隔符號，一次切完
+TICKER_SPLIT = re.compile(r'[,，\s]+')
+
+# ===========================
+# 2. AI 與下載設定
+# ===========================
+# 優先順序：Flash (快) -> Pro 1.5 (強) -> Pro (舊版穩定)
+GEMINI_MODELS = ('gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro')
+
+# curl_cffi 連線幾乎不會被擋，失敗時重試一次就夠
+MAX_RETRIES = 2
+
+# 多檔分析的執行緒數上限；真正打到 Yahoo 的併發另由 core 的閘門控制，調高這裡不會造成限流
+MAX_WORKERS = 8
+
+# 指標最多用到 120 根 (籌碼分布、K 線圖)，MA60 也只要 60 根，半年資料 (~125 根) 就夠
+HISTORY_PERIOD = "6mo"
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+)
+
+# ===========================
+# 3. 畫面樣板
+# ===========================
+# K 線圖版面固定不變，模組層級建一次即可；手機卡片只畫最近 120 根就夠清楚
+CHART_BARS = 120
+CHART_LAYOUT = dict(
+    height=250, margin=dict(l=0, r=0, t=10, b=0),
+    xaxis_rangeslider_visible=False, template="plotly_dark",
+    uirevision="kline",  # 重跑時沿用前端的縮放狀態，不整張重繪
+)
+# 手機上用不到工具列與滾輪縮放：不畫 mode bar、拿掉 plotly logo，前端少建一堆按鈕與事件
+CHART_CONFIG = dict(displayModeBar=False, displaylogo=False, scrollZoom=False, responsive=True)
+
+# 指標卡片邊框顏色，依狀態開頭的 emoji 決定
+STATUS_COLORS = {
+    "✅": "#4CAF50", "👌": "#4CAF50", "🧱": "#4CAF50",                    # Green
+    "❌": "#FF5252", "⚠️": "#FF5252", "🔨": "#FF5252", "⚡": "#FF5252",   # Red
+}
+
+# 指標卡片 HTML (預先建好樣板，每張卡片只做欄位代換)
+CARD_TEMPLATE = Template("""
+    <div style="
+        background-color: #262730; 
+        padding: 15px; 
+        border-radius: 10px; 
+        border-left: 5px solid $border_color;
+        box-shadow: 2px 2px 5px rgba(0,0,0,0.3);">
+        <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 5px;">
+            <span style="font-size: 1.1em; font-weight: bold; color: #fafafa;">$title</span>
+            <span style="font-size: 1.1em; font-weight: bold; color: $border_color;">$value</span>
+        </div>
+        <div style="font-weight: bold; color: $border_color; margin-bottom: 5px;">$status</div>
+        <div style="font-size: 0.9em; color: #dddddd; line-height: 1.5;">💡 $explanation</div>
+    </div>
+    """)
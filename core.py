@@ -0,0 +1,468 @@
+"""
+ProTrader 核心模組：資料抓取、指標計算與 AI 分析 (不含任何畫面元件)
+"""
+import streamlit as st
+import google.generativeai as genai
+import yfinance as yf
+import pandas as pd
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import json
+import logging
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+try:
+    from curl_cffi import requests as curl_requests
+    from curl_cffi import CurlError
+except ImportError:
+    curl_requests, CurlError = None, None
+try:
+    from yfinance import exceptions as yf_errors
+except ImportError:
+    yf_errors = None
+from constants import TW_STOCK_NAMES, GEMINI_MODELS, MAX_RETRIES, USER_AGENT, HISTORY_PERIOD
+
+logger = logging.getLogger(__name__)
+
+# ===========================
+# 0. 共用限速器 (Gemini 與 Yahoo 都用)
+# ===========================
+class RateLimiter:
+    """
+    Token bucket 限速器：每秒補 rate 個 token，最多存 capacity 個；沒有 token 就等到補上為止
+    用法：with limiter: ... (只包住真正發出網路請求的那一段，快取命中時根本不會經過)
+    區塊內丟出 penalize_on 指定的例外 (被限流) 時，補充速率減半 60 秒後自動恢復
+    """
+    def __init__(self, rate, capacity, penalize_on=()):
+        self.rate = rate
+        self.capacity = capacity
+        self.penalize_on = penalize_on
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._penalty_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                rate = self.rate / 2 if now < self._penalty_until else self.rate
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / rate
+            time.sleep(wait)
+
+    def penalize(self, seconds=60):
+        with self._lock:
+            self._penalty_until = time.monotonic() + seconds
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, self.penalize_on):
+            logger.warning("遭到限流 (%s)，60 秒內請求速率減半", exc_type.__name__)
+            self.penalize()
+        return False
+
+# ===========================
+# 1. AI 模型設定 (自動切換修復 404)
+# ===========================
+@st.cache_resource(show_spinner=False)
+def llm_available():
+    """
+    讀取 API Key 並設定 genai；每個伺服器行程只做一次，不隨每次重跑重設
+    """
+    try:
+        genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
+        return True
+    except Exception:
+        return False
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def _get_working_model():
+    """
+    自動挑選可用的模型，解決 404 問題；用一次 list_models 查清單，不必逐一送 ping 等失敗
+    找到可用的就記住，不必每檔股票重新探測；查詢失敗或沒有可用模型時丟例外，不把失敗快取一小時
+    """
+    available = {m.name.split('/')[-1] for m in genai.list_models() if 'generateContent' in m.supported_generation_methods}
+    for model_name in GEMINI_MODELS:
+        if model_name in available:
+            return genai.GenerativeModel(model_name)
+    raise RuntimeError("沒有可用的 Gemini 模型")
+
+AI_DISABLED_MSG = "⚠️ 請先設定 Google API Key"
+
+# 免費額度每分鐘 15 次請求：token bucket 開場可連發 5 次、之後每 6 秒補 1 次，
+# 任意 60 秒內最多 5 + 10 = 15 次；逐檔補問時才不會一起吃 429。另外同時送出的請求最多 5 個
+_AI_LIMITER = RateLimiter(rate=10 / 60, capacity=5)
+_AI_GATE = threading.Semaphore(5)
+
+@st.cache_data(ttl=3600, max_entries=200, show_spinner=False)
+def _generate(prompt, json_mode=False):
+    # 失敗時直接丟例外：st.cache_data 不快取例外，錯誤訊息才不會被記住一小時
+    # json_mode 要求模型只回傳 JSON，批次分析才解析得動
+    model = _get_working_model()
+    config = {"response_mime_type": "application/json"} if json_mode else None
+    with _AI_GATE, _AI_LIMITER:
+        return model.generate_content(prompt, generation_config=config).text
+
+def get_gemini_response(prompt):
+    if not llm_available(): return AI_DISABLED_MSG
+    try:
+        return _generate(prompt)
+    except Exception:
+        return "⚠️ AI 暫時無法連線 (可能是 API Key 額度或地區限制)"
+
+# ===========================
+# 2. 核心數據函數
+# ===========================
+
+@st.cache_resource(show_spinner=False)
+def get_yf_session():
+    """
+    所有 Yahoo 請求共用一個連線池，多執行緒同時抓也能重用 TCP/TLS 連線
+    優先用 curl_cffi 模擬 Chrome 的 TLS 指紋，Yahoo 幾乎不會回 401/429，重試與退避大多用不到
+    沒有 curl_cffi 時退回 requests (不可用 requests-cache 之類的快取 session，yfinance 會直接拒絕)
+    """
+    if curl_requests is not None:
+        return curl_requests.Session(impersonate="chrome")
+
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    # 連線層的暫時性錯誤 (429/5xx) 交給 urllib3 就地重試，不必整個 yf.download 重來
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry))
+    return session
+
+def _yf_error_types(*names):
+    # 各版 yfinance 的例外類別不同 (舊版甚至沒有 exceptions 模組)，只收集實際存在的
+    return tuple(getattr(yf_errors, n) for n in names if hasattr(yf_errors, n))
+
+# Yahoo 限流錯誤
+RATE_LIMIT_ERRORS = _yf_error_types('YFRateLimitError')
+# 確定是代號錯誤或已下市 (查無時區也是 YFTickerMissingError 的子類，但時區請求失敗會被 yfinance 吞掉，不能當成下市)
+DELISTED_ERRORS = _yf_error_types('YFPricesMissingError')
+
+# 執行緒池可以開很多條，但同時打到 Yahoo 的請求最多 5 個；
+# Yahoo 約每分鐘 60 次就會回 429，所以開場可連發 5 次，之後每秒補 1 次
+YF_MAX_CONCURRENCY = 5
+_YF_GATE = threading.BoundedSemaphore(YF_MAX_CONCURRENCY)
+_YF_LIMITER = RateLimiter(rate=1, capacity=5, penalize_on=RATE_LIMIT_ERRORS)
+# 批次下載要一次佔好幾個名額；用鎖讓佔名額這一步一次做完，兩個批次才不會各拿一半互等
+_YF_SLOTS_LOCK = threading.Lock()
+
+# 單檔與批次下載共用同一組參數 (都要還原權值)，兩條路徑的收盤價才一致
+_HISTORY_KWARGS = dict(period=HISTORY_PERIOD, auto_adjust=True, actions=False)
+
+@contextmanager
+def _yf_slots(n_slots, n_tokens):
+    """
+    同時佔用 n_slots 個並發名額並取 n_tokens 個 token，給一次會發出多個請求的批次下載用
+    """
+    with _YF_SLOTS_LOCK:
+        for _ in range(n_slots): _YF_GATE.acquire()
+    try:
+        for _ in range(n_tokens): _YF_LIMITER.acquire()
+        yield
+    finally:
+        for _ in range(n_slots): _YF_GATE.release()
+
+# 網路/解析類的可預期錯誤；其他例外代表程式有 bug，不該被吞掉
+FETCH_ERRORS = (requests.RequestException, ValueError, KeyError) + _yf_error_types('YFException') + ((CurlError,) if CurlError else ())
+# 其中連線/逾時/限流/查無時區是暫時性的，值得退避後重試；解析錯誤重試幾次結果都一樣
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError) + RATE_LIMIT_ERRORS + _yf_error_types('YFTzMissingError') + ((CurlError,) if CurlError else ())
+
+@lru_cache(maxsize=256)
+def get_ticker_info(input_str):
+    # 純查表、結果只取決於輸入字串，熱門代號重複查詢直接回傳快取
+    input_str = input_str.strip().upper()
+    if input_str.isdigit():
+        real_ticker = f"{input_str}.TW"
+        zh_name = TW_STOCK_NAMES.get(input_str, "")
+        display_name = f"{input_str} {zh_name}".strip()
+        return real_ticker, display_name, "TW"
+    return input_str, input_str, "US"
+
+@st.cache_data(ttl=900, max_entries=200, show_spinner=False)
+def _fetch_history(ticker):
+    # 價量欄位一律存成 float32：顯示與圖表用不到雙精度，快取佔用減半 (指標計算時再轉 float64 累加)
+    # yf.download 會把每檔的例外吞掉、回傳空表，看不出是被限流還是代號錯誤；
+    # 改用 Ticker.history(raise_errors=True) 讓真正的例外傳上來，限流時 _YF_LIMITER 才會減速
+    # 成功路徑不等待；只有暫時性錯誤 (或沒報錯的空表) 才指數退避 (1s 起跳、每次加倍、上限 30s)，加 0~1s 抖動避免同步重試
+    # 重試用完仍失敗就丟例外：st.cache_data 不快取例外，Yahoo 恢復後下次重跑就能抓到；只有確定下市才快取 None
+    t = yf.Ticker(ticker, session=get_yf_session())
+    for i in range(MAX_RETRIES):
+        try:
+            with _YF_GATE, _YF_LIMITER:
+                df = t.history(**_HISTORY_KWARGS, raise_errors=True)
+        except DELISTED_ERRORS as e:
+            logger.warning("%s 查無歷史股價 (代號錯誤或已下市)，停止重試: %s", ticker, e)
+            return None
+        except TRANSIENT_ERRORS as e:
+            logger.warning("%s 第 %d/%d 次下載失敗: %s", ticker, i + 1, MAX_RETRIES, e)
+            if i == MAX_RETRIES - 1: raise
+            time.sleep(min(30, 2 ** i) + random.random())
+            continue
+        if not df.empty and 'Close' in df.columns:
+            # history 回傳交易所時區的索引；去掉時區但保留當地日期，與批次下載的格式一致
+            df.index = df.index.tz_localize(None)
+            return df.astype(np.float32)
+        logger.warning("%s 第 %d/%d 次下載得到空表", ticker, i + 1, MAX_RETRIES)
+        if i < MAX_RETRIES - 1: time.sleep(min(30, 2 ** i) + random.random())
+    raise ValueError(f"{ticker} 重試 {MAX_RETRIES} 次仍是空表")
+
+def fetch_data_robust(ticker):
+    """
+    單檔歷史股價；抓不到時回傳 None (不快取失敗，見 _fetch_history)
+    """
+    try:
+        return _fetch_history(ticker)
+    except FETCH_ERRORS as e:
+        logger.warning("%s 下載失敗: %s", ticker, e)
+        return None
+
+@st.cache_data(ttl=900, max_entries=200, show_spinner=False)
+def _fetch_batch(tickers):
+    """
+    一次 yf.download 下載多檔歷史股價，回傳 {代號: df}；批次裡缺資料的代號不放進結果
+    yfinance 內部仍是每檔各發一個請求 (以 threads 並行)，所以每檔各扣一個 token，並行數也不超過並發上限
+    整批失敗時丟例外不進快取
+    """
+    frames = {}
+    threads = min(len(tickers), YF_MAX_CONCURRENCY)
+    with _yf_slots(threads, len(tickers)):
+        bulk = yf.download(" ".join(tickers), **_HISTORY_KWARGS, group_by='ticker', progress=False, threads=threads, session=get_yf_session())
+    if bulk.empty:
+        raise ValueError("批次下載結果為空")
+
+    for ticker in tickers:
+        # yfinance 0.2.48 起一律回傳 (代號, 欄位) 兩層；只有 0.2.40–0.2.47 下載單檔時還是單層欄位
+        # group_by='ticker' 切出來的每檔欄位不會重複，不必再去重
+        if not isinstance(bulk.columns, pd.MultiIndex): df = bulk
+        elif ticker in bulk.columns.get_level_values(0): df = bulk[ticker]
+        else: continue
+        # 台美股交易日不同，合併下載會有整列空值
+        df = df.dropna(how='all')
+        if not df.empty and 'Close' in df.columns:
+            frames[ticker] = df.astype(np.float32)
+    return frames
+
+def fetch_batch(tickers):
+    try:
+        return _fetch_batch(tickers)
+    except FETCH_ERRORS as e:
+        logger.warning("批次下載失敗，改逐檔下載: %s", e)
+        return {}
+
+@st.cache_data(ttl=3600, max_entries=200, show_spinner=False)
+def _fetch_news(ticker):
+    # 失敗時丟例外不進快取，免得一次限流就一小時看不到新聞
+    t = yf.Ticker(ticker, session=get_yf_session())
+    with _YF_GATE, _YF_LIMITER:
+        return t.news
+
+def fetch_news(ticker):
+    try:
+        return _fetch_news(ticker)
+    except FETCH_ERRORS as e:
+        logger.warning("%s 新聞讀取失敗: %s", ticker, e)
+        return []
+
+def moving_averages(a, windows):
+    """
+    同一次 cumsum 算出多條均線 (畫 K 線圖也用)，前 w-1 筆補 NaN，與 pandas rolling 結果一致
+    資料不足一個視窗時整條都是 NaN
+    """
+    c = np.concatenate(([0.0], np.cumsum(a)))
+    out = {}
+    for w in windows:
+        ma = np.full(len(a), np.nan)
+        if len(a) >= w:
+            ma[w - 1:] = (c[w:] - c[:-w]) / w
+        out[w] = ma
+    return out
+
+def calculate_volume_profile(close, volume, bins=30):
+    """
+    籌碼分布：收盤價切成 bins 格並以成交量加權，回傳 (各格量, 邊界, 大量區中間價)
+    """
+    hist, edges = np.histogram(close, bins=bins, weights=volume)
+    idx = hist.argmax()
+    return hist, edges, (edges[idx] + edges[idx + 1]) / 2
+
+def compute_indicators(close, volume, mas):
+    """
+    一次算出評分、診斷書與標題漲跌要用的所有純量指標，各函數共用，不再各自重算
+    close / volume 為 float64 numpy 陣列，mas 為 moving_averages 的結果
+    """
+    ma20, ma60 = mas[20][-1], mas[60][-1]
+    # 量能只需要最後一格的 5 日均量，直接對最後 5 筆取平均
+    volma5 = float(volume[-5:].mean()) if len(volume) >= 5 else np.nan
+    # 有 NaN 時 np.histogram 無法自動決定範圍，先濾掉
+    recent_close, recent_vol = close[-120:], volume[-120:]
+    valid = np.isfinite(recent_close) & np.isfinite(recent_vol)
+    vp_price = calculate_volume_profile(recent_close[valid], recent_vol[valid])[2] if valid.any() else 0
+
+    price, prev_price = close[-1], close[-2]
+    change = price - prev_price
+
+    return {
+        'n': len(close), 'price': price, 'prev_price': prev_price, 'volume': volume[-1],
+        'change': change, 'change_pct': (change / prev_price) * 100,
+        'ma20': ma20, 'ma60': ma60, 'volma5': volma5,
+        'bias': ((price - ma20) / ma20) * 100,
+        'vp_price': vp_price,
+    }
+
+def calculate_technical_score(ind):
+    if ind['n'] < 60 or np.isnan(ind['ma60']): return 50, "資料不足"
+    score = 50
+    price, ma20, ma60 = ind['price'], ind['ma20'], ind['ma60']
+    
+    # 1. 均線趨勢
+    if ma20 > ma60 and price > ma20: score += 25
+    elif price < ma60: score -= 25
+    # 2. 短線支撐
+    if price > ma20: score += 10
+    # 3. 量能
+    vol_ma5 = ind['volma5']
+    if vol_ma5 > 0 and (ind['volume'] / vol_ma5) > 1.5: score += 15
+        
+    final_score = min(100, max(0, score))
+    
+    if final_score >= 75: trend = "🔥 強力多頭"
+    elif final_score >= 60: trend = "📈 偏多震盪"
+    elif final_score <= 40: trend = "📉 偏空修正"
+    else: trend = "⚖️ 盤整觀望"
+    
+    return final_score, trend
+
+def _headline_title(item):
+    # 新版 yfinance 把標題包在 content 底下，舊版則在最外層
+    if not item: return None
+    return item.get('title') or (item.get('content') or {}).get('title')
+
+def analyze_ai_summary(news_list, ticker, trend_tag):
+    # 沒有 API Key 時根本不會抓新聞，先擋下來，免得誤報成「無近期新聞」
+    if not llm_available(): return AI_DISABLED_MSG
+    if not news_list: return "無近期新聞。"
+    # 很多台股小型股的新聞標題是空的，沒有有效標題就不必打 Gemini
+    titles = tuple(t for t in map(_headline_title, news_list[:5]) if t)
+    if not titles: return "無有效新聞可分析。"
+    return get_gemini_response(_headline_prompt(titles, ticker, trend_tag))
+
+def analyze_ai_batch(entries):
+    """
+    多檔標的的新聞合併成一次 Gemini 請求 (回傳 JSON)，N 檔只付一次網路往返與模型暖身
+    entries 為 [(ticker, trend_tag, news_list), ...]；回傳 {ticker: AI 觀點}
+    JSON 解析失敗或模型漏掉的標的不會出現在結果中，由呼叫端改用 analyze_ai_summary 逐檔補問
+    """
+    if not llm_available(): return {ticker: AI_DISABLED_MSG for ticker, _, _ in entries}
+    comments, pending = {}, []
+    for ticker, trend_tag, news_list in entries:
+        titles = tuple(t for t in map(_headline_title, (news_list or [])[:5]) if t)
+        if not news_list: comments[ticker] = "無近期新聞。"
+        elif not titles: comments[ticker] = "無有效新聞可分析。"
+        else: pending.append((ticker, trend_tag, titles))
+
+    # 只剩一檔就不必合併，逐檔 prompt 的快取命中率也比較高
+    if len(pending) < 2: return comments
+    try:
+        data = json.loads(_generate(_batch_prompt(pending), json_mode=True))
+    except Exception:
+        return comments
+    if not isinstance(data, dict): return comments
+
+    # 回覆以區塊編號對應 (1, 2, ...)，不靠模型照抄「2330 台積電」這種含空白、中文的名稱
+    for no, (ticker, _, _) in enumerate(pending, 1):
+        item = data.get(str(no))
+        if isinstance(item, dict) and item.get("conclusion"):
+            comments[ticker] = f"1. 【一句話結論】：{item['conclusion']}\n2. 【操作建議】：{item.get('action', '觀望')}"
+    return comments
+
+def _batch_prompt(pending):
+    blocks = "\n\n".join(
+        f"== 編號 {no}：{ticker} (技術面：{trend_tag}) ==\n" + "\n".join(f"- {t}" for t in titles)
+        for no, (ticker, trend_tag, titles) in enumerate(pending, 1)
+    )
+    return f"""
+    你是手機看盤 App 的 AI 助手。請根據下列每檔標的的新聞標題，各給出「手機易讀」結論 (每檔 100 字內)。
+    只回傳一個 JSON 物件，key 只能是各區塊的編號數字字串 ("1"、"2"、...)，不要用股票代號或名稱當 key，
+    value 為 {{"conclusion": "(利多/利空) + 原因", "action": "拉回買/觀望/停損"}}。
+    例如：{{"1": {{"conclusion": "...", "action": "觀望"}}, "2": {{...}}}}
+    {blocks}
+    """
+
+def _headline_prompt(titles, ticker, trend_tag):
+    # 同一組標題產生的 prompt 完全相同，_generate 的快取即以標題內容為 key
+    txt = "\n".join(f"- {t}" for t in titles)
+    return f"""
+    你是手機看盤 App 的 AI 助手。標的：{ticker} (技術面：{trend_tag})
+    請根據新聞標題給出「手機易讀」結論 (100字內)：
+    1. 【一句話結論】：(利多/利空) + 原因。
+    2. 【操作建議】：(拉回買/觀望/停損)。
+    新聞：{txt}
+    """
+
+@st.cache_data(ttl=900, max_entries=200, show_spinner=False)
+def _analyze(t_str, _prefetched=None):
+    """
+    單一標的的股價與指標計算；_prefetched 為批次下載取得的歷史股價，沒有時才單獨下載
+    _prefetched 不參與快取 key，15 分鐘內同一代號直接命中；沒有可用股價時丟 LookupError，失敗結果不進快取
+    """
+    real_ticker, display_name, market_loc = get_ticker_info(t_str)
+    df = fetch_data_robust(real_ticker) if _prefetched is None else _prefetched
+    if df is None:
+        raise LookupError(f"{display_name} 查無歷史股價")
+
+    # 每檔只把需要的欄位轉成 numpy 一次，後續指標都吃陣列 (切片皆為 view，不複製)
+    # cumsum 遇到 NaN 會一路傳下去，缺收盤價的列先剔除；正常資料不多做一次複製
+    close = df['Close'].to_numpy(dtype=float)
+    valid = ~np.isnan(close)
+    if not valid.all():
+        df, close = df[valid], close[valid]
+    # 漲跌要用到前一天收盤，剛上市只有一根 K 棒時無法分析
+    if len(close) < 2:
+        raise LookupError(f"{display_name} 股價資料不足兩天")
+    volume = df['Volume'].to_numpy(dtype=float)
+    mas = moving_averages(close, (20, 60))
+    df = df.assign(MA20=mas[20], MA60=mas[60])
+    ind = compute_indicators(close, volume, mas)
+
+    score, trend_tag = calculate_technical_score(ind)
+
+    return {
+        "ok": True, "display_name": display_name, "market_loc": market_loc,
+        "df": df, "ind": ind, "score": score, "trend_tag": trend_tag,
+        "last_price": ind['price'], "change": ind['change'], "change_pct": ind['change_pct'],
+    }
+
+def analyze_one(t_str, prefetched=None):
+    """
+    單一標的的抓資料與指標計算 (在背景執行緒執行，不可呼叫任何 st 指令)
+    新聞另外抓、不跟指標一起快取，新聞失敗不會把空清單鎖進分析結果
+    """
+    real_ticker, display_name, _ = get_ticker_info(t_str)
+
+    # 股價與新聞走不同端點，彼此獨立，同時抓取；新聞只餵給 AI，沒有 API Key 就不抓
+    with ThreadPoolExecutor(max_workers=1) as io_pool:
+        fut_news = io_pool.submit(fetch_news, real_ticker) if llm_available() else None
+        try:
+            res = _analyze(t_str, prefetched)
+        except LookupError as e:
+            logger.warning("%s", e)
+            return {"ok": False, "display_name": display_name}
+        news = fut_news.result() if fut_news is not None else []
+
+    return {**res, "news": news}